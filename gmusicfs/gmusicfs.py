@@ -19,6 +19,7 @@ import tempfile
 import threading
 import logging
 import pprint
+import collections
 
 from fuse import FUSE, FuseOSError, Operations, LoggingMixIn, fuse_get_context
 from gmusicapi import Mobileclient as GoogleMusicAPI
@@ -28,7 +29,6 @@ from gmusicapi import Webclient as GoogleMusicWebAPI
 
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger('gmusicfs')
-deviceId=None
 pp = pprint.PrettyPrinter(indent=4) # DEBUG
 
 # Size of the ID3v1 trailer appended to the mp3 file (at read time)
@@ -36,6 +36,15 @@ pp = pprint.PrettyPrinter(indent=4) # DEBUG
 # The read function will read size bytes - 128 since we have to generate this 128 bytes.
 ID3V1_TRAILER_SIZE = 128
 
+# Track fields coming from the store catalog, shared between the libraries
+# of a multi-account mount for the tracks having the same storeId.
+CATALOG_TRACK_KEYS = frozenset([
+    'title', 'artist', 'composer', 'album', 'albumArtist', 'year',
+    'comment', 'trackNumber', 'discNumber', 'totalTrackCount',
+    'totalDiscCount', 'genre', 'durationMillis', 'estimatedSize',
+    'albumArtRef', 'artistArtRef', 'artistId', 'albumId', 'storeId',
+    'nid', 'trackType', 'beatsPerMinute', 'explicitType', 'contentType'])
+
 
 def formatNames(string_from):
     return re.sub('/', '-', string_from)
@@ -44,6 +53,47 @@ def formatNames(string_from):
 class NoCredentialException(Exception):
     pass
 
+def read_config():
+    'Read $HOME/.gmusicfs, making sure it is protected'
+    cred_path = os.path.join(os.path.expanduser('~'), '.gmusicfs')
+    if not os.path.isfile(cred_path):
+        raise NoCredentialException(
+            'No username/password was specified. No config file could '
+            'be found either. Try creating %s and specifying your '
+            'username/password there. Make sure to chmod 600.'
+            % cred_path)
+    if not oct(os.stat(cred_path)[os.path.stat.ST_MODE]).endswith('00'):
+        raise NoCredentialException(
+            'Config file is not protected. Please run: '
+            'chmod 600 %s' % cred_path)
+    config = configparser.ConfigParser()
+    config.read(cred_path)
+    return config, cred_path
+
+def read_accounts(require_device_id=True):
+    """Get the accounts listed in the config file as [account <name>]
+    sections: 'name' -> (username, password, deviceId)"""
+    config, cred_path = read_config()
+    accounts = collections.OrderedDict()
+    for section in config.sections():
+        if not section.startswith('account '):
+            continue
+        name = formatNames(section[len('account '):].strip().lower())
+        username = config.get(section, 'username', fallback='')
+        password = config.get(section, 'password', fallback='')
+        device_id = config.get(section, 'deviceId', fallback='')
+        if name in ('', '.', '..') or not username or not password or \
+                (require_device_id and not device_id):
+            raise NoCredentialException(
+                'Incomplete account %r in config file'
+                ': %s' % (section, cred_path))
+        if name in accounts:
+            raise NoCredentialException(
+                'Duplicate account %r in config file'
+                ': %s' % (name, cred_path))
+        accounts[name] = (username, password, device_id)
+    return accounts
+
 class Album(object):
     'Keep record of Album information'
     def __init__(self, library, normtitle):
@@ -85,7 +135,7 @@ class Album(object):
 
     def get_track_stream(self, track):
         "Get the track stream URL"
-        return self.library.api.get_stream_url(track['id'], deviceId)
+        return self.library.api.get_stream_url(track['id'], self.library.device_id)
 
     def get_cover_url(self):
         'Get the album cover image URL'
@@ -126,21 +176,51 @@ class Album(object):
     def __repr__(self):
         return '<Album \'{title}\'>'.format(title=self.normtitle)
 
+class Playlist(object):
+    'Keep record of Playlist information, resolving entries on first use'
+    def __init__(self, library, playlist):
+        self.library = library
+        self.id = playlist['id']
+        self.name = formatNames(playlist['name'].lower())
+        self.__tracks = None
+
+    def get_tracks(self):
+        """Resolve the playlist entries against the library on first access.
+        Entries that could not be resolved are kept as None so that the
+        position of the other entries doesn't change."""
+        if self.__tracks is None:
+            self.__tracks = self.library.get_playlist_tracks(self.id)
+            log.debug('Playlist %s: %d entries resolved.' % (self.name, len(self.__tracks)))
+        return self.__tracks
+
+    def get_track(self, tracknum):
+        'Get the track at a position (starting at 1), None if there is none'
+        tracks = self.get_tracks()
+        if 0 < tracknum <= len(tracks):
+            return tracks[tracknum - 1]
+        return None
+
+    def __repr__(self):
+        return '<Playlist \'{name}\'>'.format(name=self.name)
+
 class MusicLibrary(object):
     'Read information about your Google Music library'
 
-    def __init__(self, username=None, password=None,
-                 true_file_size=False, scan=True, verbose=0):
+    def __init__(self, username=None, password=None, device_id=None,
+                 true_file_size=False, scan=True, verbose=0, catalog=None):
         self.verbose = False
         if verbose > 1:
             self.verbose = True
 
+        self.device_id = device_id
+        self.__catalog = catalog # 'storeId' -> (first track, {catalog fields}), shared
         self.__login_and_setup(username, password)
 
         self.__artists = {} # 'artist name' -> {'album name' : Album(), ...}
         self.__albums = [] # [Album(), ...]
         self.__tracks = {}
         self.__playlists = {}
+        self.__playlist_entries = None # 'playlist id' -> [entry, ...]
         if scan:
             self.rescan()
         self.true_file_size = true_file_size
@@ -150,40 +230,28 @@ class MusicLibrary(object):
         self.__albums = [] # [Album(), ...]
         self.__tracks = {}
         self.__playlists = {}
+        self.__playlist_entries = None # 'playlist id' -> [entry, ...]
         self.__aggregate_albums()
 
     def __login_and_setup(self, username=None, password=None):
         # If credentials are not specified, get them from $HOME/.gmusicfs
         if not username or not password:
-            cred_path = os.path.join(os.path.expanduser('~'), '.gmusicfs')
-            if not os.path.isfile(cred_path):
-                raise NoCredentialException(
-                    'No username/password was specified. No config file could '
-                    'be found either. Try creating %s and specifying your '
-                    'username/password there. Make sure to chmod 600.'
-                    % cred_path)
-            if not oct(os.stat(cred_path)[os.path.stat.ST_MODE]).endswith('00'):
-                raise NoCredentialException(
-                    'Config file is not protected. Please run: '
-                    'chmod 600 %s' % cred_path)
-            self.config = configparser.ConfigParser()
-            self.config.read(cred_path)
+            self.config, cred_path = read_config()
             username = self.config.get('credentials','username')
             password = self.config.get('credentials','password')
-            global deviceId
-            deviceId = self.config.get('credentials','deviceId')
+            self.device_id = self.config.get('credentials','deviceId')
             if not username or not password:
                 raise NoCredentialException(
                     'No username/password could be read from config file'
                     ': %s' % cred_path)
-            if not deviceId:
+            if not self.device_id:
                 raise NoCredentialException(
                     'No deviceId could be read from config file'
                     ': %s' % cred_path)
 
         self.api = GoogleMusicAPI(debug_logging=self.verbose)
         log.info('Logging in...')
-        self.api.login(username, password, deviceId)
+        self.api.login(username, password, self.device_id)
         log.info('Login successful.')
 
     def __aggregate_albums(self):
@@ -193,6 +261,7 @@ class MusicLibrary(object):
         tracks = self.api.get_all_songs()
         for track in tracks:
             log.debug('track = %s' % pp.pformat(track))
+            track = self.__intern_track(track)
             # Prefer the album artist over the track artist if there is one:
             artist = formatNames(track['albumArtist'].lower())
             if artist.strip() == '':
@@ -219,22 +288,77 @@ class MusicLibrary(object):
         log.debug('%d tracks loaded.' % len(tracks))
         log.debug('%d artists loaded.' % len(self.__artists))
         log.debug('%d albums loaded.' % len(self.__albums))
-        playlists = self.api.get_all_user_playlist_contents()
-        for playlist in playlists:
-            name = formatNames(playlist['name'].lower())
-            log.debug('Playlist %s' % name)
-            self.__playlists[name] = []
-            entries = playlist['tracks']
-            for entry in entries:
-                log.debug('Playlist entry = %s' % pp.pformat(entry))
-                if 'track' in entry:
-                    track = entry['track']
-                    track['id'] = entry['trackId']
-                else:
-                    track = self.__tracks[entry['trackId']]
-                self.__playlists[name].append(track)
+        # Only fetch the playlist names and ids here, entries are resolved
+        # when a playlist is first accessed. Skip the subscribed playlists
+        # like get_all_user_playlist_contents() does:
+        for playlist in self.api.get_all_playlists():
+            if playlist.get('type') == 'SHARED':
+                continue
+            playlist = Playlist(self, playlist)
+            self.__playlists[playlist.name] = playlist
         log.debug('%d playlists loaded.' % len(self.__playlists))
 
+    def __intern_track(self, track):
+        """Share the catalog fields of a store track with the other
+        libraries of the process, only the fields that differ (ids,
+        timestamps, play count, edited metadata...) are kept per library.
+        The first library having a track keeps it as is, the catalog fields
+        are only split out once another library has the same storeId: a
+        track that isn't shared only costs a catalog slot."""
+        store_id = track.get('storeId', None)
+        if self.__catalog is None or not store_id:
+            return track
+        first, shared = self.__catalog.get(store_id, (None, None))
+        if first is None:
+            self.__catalog[store_id] = (track, None)
+            return track
+        if shared is None:
+            shared = dict((k, v) for k, v in first.items()
+                          if k in CATALOG_TRACK_KEYS)
+            self.__catalog[store_id] = (first, shared)
+        own = dict((k, v) for k, v in track.items()
+                   if k not in shared or shared[k] != v)
+        return collections.ChainMap(own, shared)
+
+    def get_playlist_tracks(self, playlist_id):
+        """Get the tracks of a playlist, sorted by position.
+        The entries of all the user playlists are read at once from the
+        user entry feed the first time a playlist is accessed."""
+        if self.__playlist_entries is None:
+            self.__playlist_entries = self.__read_playlist_entries()
+        tracks = self.__resolve_playlist_entries(
+            self.__playlist_entries.get(playlist_id, []))
+        # The Playlist keeps its resolved tracks, drop the entries:
+        self.__playlist_entries.pop(playlist_id, None)
+        return tracks
+
+    def __read_playlist_entries(self):
+        """Read the user entry feed: 'playlist id' -> [(trackId, track), ...],
+        keeping only what is needed to resolve the entries"""
+        log.info('Gathering playlist entries...')
+        playlist_entries = {}
+        # Private, but it is the feed get_all_user_playlist_contents() uses:
+        for entry in self.api._get_all_playlist_entries():
+            playlist_entries.setdefault(entry['playlistId'], []).append(
+                (int(entry['absolutePosition']), entry['trackId'], entry.get('track')))
+        for playlist_id, entries in playlist_entries.items():
+            entries.sort(key=operator.itemgetter(0))
+            playlist_entries[playlist_id] = [e[1:] for e in entries]
+        return playlist_entries
+
+    def __resolve_playlist_entries(self, entries):
+        'Map playlist entries to track dicts, reusing the library tracks'
+        tracks = []
+        for track_id, entry_track in entries:
+            track = self.__tracks.get(track_id, None)
+            if track is None and entry_track is not None:
+                track = self.__intern_track(entry_track)
+                track['id'] = track_id
+            elif track is None:
+                log.warning('Unknown playlist entry %s' % track_id)
+            tracks.append(track)
+        return tracks
+
     def get_artists(self):
         return self.__artists
 
@@ -254,8 +378,10 @@ class MusicLibrary(object):
 class GMusicFS(LoggingMixIn, Operations):
     'Google Music Filesystem'
     def __init__(self, path, username=None, password=None,
-                 true_file_size=False, verbose=0, scan_library=True):
+                 true_file_size=False, verbose=0, scan_library=True,
+                 accounts=None):
         Operations.__init__(self)
+        self.account_dir = re.compile('^/(?P<account>[^/]+)(?P<path>/.*)?$')
         self.artist_dir = re.compile('^/artists/(?P<artist>[^/]+)$')
         self.artist_album_dir = re.compile(
             '^/artists/(?P<artist>[^/]+)/(?P<year>[0-9]{4}) - (?P<album>[^/]+)$')
@@ -269,13 +395,40 @@ class GMusicFS(LoggingMixIn, Operations):
 
         self.__open_files = {} # path -> urllib2_obj
 
-        # login to google music and parse the tracks:
-        self.library = MusicLibrary(username, password,
-                                    true_file_size=true_file_size, verbose=verbose, scan=scan_library)
+        # login to google music and parse the tracks, either for a single
+        # account mounted at the root or for several accounts, each one
+        # mounted as a top level directory:
+        self.__libraries = collections.OrderedDict() # 'account' -> MusicLibrary()
+        if accounts:
+            catalog = {} # 'storeId' -> (first track, {catalog fields}), see MusicLibrary
+            for account, (username, password, device_id) in accounts.items():
+                log.info('Loading account %s...' % account)
+                self.__libraries[account] = MusicLibrary(
+                    username, password, device_id, true_file_size=true_file_size,
+                    verbose=verbose, scan=scan_library, catalog=catalog)
+        else:
+            self.__libraries[None] = MusicLibrary(
+                username, password, true_file_size=true_file_size,
+                verbose=verbose, scan=scan_library)
         log.info("Filesystem ready : %s" % path)
 
     def cleanup(self):
-        self.library.cleanup()
+        for library in self.__libraries.values():
+            library.cleanup()
+
+    def __split_path(self, path):
+        """Get the library serving a path and the path relative to this
+        library. The library is None for the root of a multi-account mount."""
+        if None in self.__libraries:
+            return self.__libraries[None], path
+        account_m = self.account_dir.match(path)
+        if not account_m:
+            return None, path
+        parts = account_m.groupdict()
+        library = self.__libraries.get(parts['account'], None)
+        if library is None:
+            raise FuseOSError(ENOENT)
+        return library, parts['path'] or '/'
 
     def track_to_stat(self, track):
         st = {
@@ -292,6 +445,7 @@ class GMusicFS(LoggingMixIn, Operations):
 
     def getattr(self, path, fh=None):
         'Get info about a file/dir'
+        library, path = self.__split_path(path)
         artist_dir_m = self.artist_dir.match(path)
         artist_album_dir_m = self.artist_album_dir.match(path)
         artist_album_track_m = self.artist_album_track.match(path)
@@ -318,13 +472,13 @@ class GMusicFS(LoggingMixIn, Operations):
             pass
         elif artist_album_track_m:
             parts = artist_album_track_m.groupdict()
-            album = self.library.get_artists()[
+            album = library.get_artists()[
                 parts['artist']][parts['album']]
             track = album.get_track(parts['track'])
             st = self.track_to_stat(track)
         elif artist_album_image_m:
             parts = artist_album_image_m.groupdict()
-            album = self.library.get_artists()[
+            album = library.get_artists()[
                 parts['artist']][parts['album']]
             cover_size = album.get_cover_size()
             if cover_size is None:
@@ -333,11 +487,21 @@ class GMusicFS(LoggingMixIn, Operations):
                 'st_mode' : S_IFREG or 444,
                 'st_size' : cover_size }
         elif playlist_dir_m:
-            pass
+            playlist = library.get_playlists().get(
+                playlist_dir_m.groupdict()['playlist'], None)
+            if playlist is None:
+                raise FuseOSError(ENOENT)
+            try:
+                playlist.get_tracks()
+            except Exception:
+                # Don't fail a stat of the directory, listing it will retry:
+                log.exception('Failed to load playlist %s' % playlist.name)
         elif playlist_track_m:
             parts = playlist_track_m.groupdict()
-            playlist = self.library.get_playlists()[parts['playlist']]
-            track = playlist[int(parts['tracknum'], 10) - 1]
+            playlist = library.get_playlists()[parts['playlist']]
+            track = playlist.get_track(int(parts['tracknum'], 10))
+            if track is None:
+                raise FuseOSError(ENOENT)
             st = self.track_to_stat(track)
         else:
             raise FuseOSError(ENOENT)
@@ -345,26 +509,29 @@ class GMusicFS(LoggingMixIn, Operations):
         return st
 
     def open(self, path, fh):
+        library, path = self.__split_path(path)
         artist_album_track_m = self.artist_album_track.match(path)
         artist_album_image_m = self.artist_album_image.match(path)
         playlist_track_m = self.playlist_track.match(path)
 
         if artist_album_track_m:
             parts = artist_album_track_m.groupdict()
-            album = self.library.get_artists()[
+            album = library.get_artists()[
                 parts['artist']][parts['album']]
             track = album.get_track(parts['track'])
             url = album.get_track_stream(track)
         elif artist_album_image_m:
             parts = artist_album_image_m.groupdict()
-            album = self.library.get_artists()[
+            album = library.get_artists()[
                 parts['artist']][parts['album']]
             url = album.get_cover_url()
         elif playlist_track_m:
             parts = playlist_track_m.groupdict()
-            playlist = self.library.get_playlists()[parts['playlist']]
-            track = playlist[int(parts['tracknum'], 10) - 1]
-            url = self.library.api.get_stream_url(track['id'], deviceId)
+            playlist = library.get_playlists()[parts['playlist']]
+            track = playlist.get_track(int(parts['tracknum'], 10))
+            if track is None:
+                raise FuseOSError(ENOENT)
+            url = library.api.get_stream_url(track['id'], library.device_id)
         else:
             RuntimeError('unexpected opening of path: %r' % path)
 
@@ -384,10 +551,11 @@ class GMusicFS(LoggingMixIn, Operations):
         u = self.__open_files.get(fh, None)
         if u is None:
             raise RuntimeError('unexpected path: %r' % path)
+        library, path = self.__split_path(path)
         artist_album_track_m = self.artist_album_track.match(path)
         if artist_album_track_m and (int(u.headers['Content-Length']) < (offset + size)):
             parts = artist_album_track_m.groupdict()
-            album = self.library.get_artists()[
+            album = library.get_artists()[
                 parts['artist']][parts['album']]
             track = album.get_track(parts['track'])
             # Genre tag is always set to Other as Google MP3 genre tags are not id3v1 id.
@@ -406,21 +574,24 @@ class GMusicFS(LoggingMixIn, Operations):
         return buf
 
     def readdir(self, path, fh):
+        library, path = self.__split_path(path)
         artist_dir_m = self.artist_dir.match(path)
         artist_album_dir_m = self.artist_album_dir.match(path)
         artist_album_track_m = self.artist_album_track.match(path)
         artist_album_image_m = self.artist_album_image.match(path)
         playlist_dir_m = self.playlist_dir.match(path)
 
-        if path == '/':
+        if library is None:
+            return ['.', '..'] + list(self.__libraries.keys())
+        elif path == '/':
             return ['.', '..', 'artists', 'playlists']
         elif path == '/artists':
-            return  ['.','..'] + list(self.library.get_artists().keys())
+            return  ['.','..'] + list(library.get_artists().keys())
         elif path == '/playlists':
-            return  ['.','..'] + list(self.library.get_playlists().keys())
+            return  ['.','..'] + list(library.get_playlists().keys())
         elif artist_dir_m:
             # Artist directory, lists albums.
-            albums = self.library.get_artist_albums(
+            albums = library.get_artist_albums(
                 artist_dir_m.groupdict()['artist'])
             # Sort albums by year:
             album_dirs = ['{year:04d} - {name}'.format(
@@ -429,7 +600,7 @@ class GMusicFS(LoggingMixIn, Operations):
         elif artist_album_dir_m:
             # Album directory, lists tracks.
             parts = artist_album_dir_m.groupdict()
-            album = self.library.get_artists()[
+            album = library.get_artists()[
                 parts['artist']][parts['album']]
             files = ['.','..']
             for track in album.get_tracks(get_size=True):
@@ -440,36 +611,36 @@ class GMusicFS(LoggingMixIn, Operations):
                 files.append('cover.jpg')
             return files
         elif playlist_dir_m:
-            tracknum = 1
-            playlist = self.library.get_playlists()[playlist_dir_m.groupdict()['playlist']]
+            playlist = library.get_playlists()[playlist_dir_m.groupdict()['playlist']]
             files = ['.', '..']
-            for track in playlist:
+            # Number the tracks by their position in the playlist, skipping
+            # the unresolved entries:
+            for tracknum, track in enumerate(playlist.get_tracks(), 1):
+                if track is None:
+                    continue
                 files.append('%03d - %s - %s - %s.mp3' % (tracknum, formatNames(track['artist'].lower()), formatNames(track['album'].lower()), formatNames(track['title'].lower())))
-                tracknum += 1
             return files
 
 
 def getDeviceId(verbose=False):
-    cred_path = os.path.join(os.path.expanduser('~'), '.gmusicfs')
-    if not os.path.isfile(cred_path):
-        raise NoCredentialException(
-            'No username/password was specified. No config file could '
-            'be found either. Try creating %s and specifying your '
-            'username/password there. Make sure to chmod 600.'
-            % cred_path)
-    if not oct(os.stat(cred_path)[os.path.stat.ST_MODE]).endswith('00'):
-        raise NoCredentialException(
-            'Config file is not protected. Please run: '
-            'chmod 600 %s' % cred_path)
-    config = configparser.ConfigParser()
-    config.read(cred_path)
-    username = config.get('credentials','username')
-    password = config.get('credentials','password')
-    if not username or not password:
-        raise NoCredentialException(
-            'No username/password could be read from config file'
-            ': %s' % cred_path)
+    """Print the device ids of the [credentials] account, or of each
+    [account <name>] section of the config file"""
+    accounts = read_accounts(require_device_id=False)
+    if not accounts:
+        config, cred_path = read_config()
+        username = config.get('credentials','username')
+        password = config.get('credentials','password')
+        if not username or not password:
+            raise NoCredentialException(
+                'No username/password could be read from config file'
+                ': %s' % cred_path)
+        printDeviceIds(username, password, verbose)
+        return
+    for account, (username, password, _) in accounts.items():
+        print('[account %s]' % account)
+        printDeviceIds(username, password, verbose)
 
+def printDeviceIds(username, password, verbose=False):
     api = GoogleMusicWebAPI(debug_logging=verbose)
     log.info('Logging in...')
     logged_in = api.login(username, password)
@@ -547,7 +718,9 @@ def main():
 
 
 
-    fs = GMusicFS(mountpoint, true_file_size=args.true_file_size, verbose=verbosity, scan_library= not args.nolibrary)
+    accounts = read_accounts()
+    fs = GMusicFS(mountpoint, true_file_size=args.true_file_size, verbose=verbosity, scan_library= not args.nolibrary,
+                  accounts=accounts)
     try:
         fuse = FUSE(fs, mountpoint, foreground=args.foreground,
                     ro=True, nothreads=True, allow_other=args.allusers)